@@ -2,11 +2,13 @@
 # Copyright (c) 2016
 # Author: Vitally Tezhe
 import logging
+import struct
 import time
 
 from mycodo.databases.models import DeviceMeasurements
 from mycodo.inputs.base_input import AbstractInput
 from mycodo.inputs.sensorutils import calculate_altitude
+from mycodo.inputs.sensorutils import get_smbus
 from mycodo.utils.database import db_retrieve_table_daemon
 
 # Measurements
@@ -42,7 +44,7 @@ INPUT_INFORMATION = {
     'options_disabled': ['interface'],
 
     'dependencies_module': [
-        ('pip-pypi', 'Adafruit_GPIO', 'Adafruit_GPIO')
+        ('pip-pypi', 'smbus2', 'smbus2')
     ],
     'interfaces': ['I2C'],
     'i2c_location': [
@@ -57,6 +59,10 @@ BMP280_ULTRALOWPOWER = 0
 BMP280_STANDARD = 1
 BMP280_HIGHRES = 2
 BMP280_ULTRAHIGHRES = 3
+_VALID_MODES = frozenset((BMP280_ULTRALOWPOWER,
+                          BMP280_STANDARD,
+                          BMP280_HIGHRES,
+                          BMP280_ULTRAHIGHRES))
 
 # BMP280 Temperature Registers
 BMP280_REGISTER_DIG_T1 = 0x88
@@ -74,17 +80,108 @@ BMP280_REGISTER_DIG_P8 = 0x9C
 BMP280_REGISTER_DIG_P9 = 0x9E
 
 BMP280_REGISTER_CONTROL = 0xF4
+BMP280_REGISTER_CONFIG = 0xF5
 # Pressure measurments
 BMP280_REGISTER_PRESSUREDATA_MSB = 0xF7
 BMP280_REGISTER_PRESSUREDATA_LSB = 0xF8
 BMP280_REGISTER_PRESSUREDATA_XLSB = 0xF9
-# Temperature measurments
+# Temperature measurments (contiguous with pressure, burst-read together)
 BMP280_REGISTER_TEMPDATA_MSB = 0xFA
 BMP280_REGISTER_TEMPDATA_LSB = 0xFB
 BMP280_REGISTER_TEMPDATA_XLSB = 0xFC
 
-# Commands
+# Raw pressure and temperature while the data registers hold their power-on
+# reset value (0x800000), i.e. no conversion since the sensor last reset
+BMP280_RAW_RESET_VALUE = 0x80000
+
+# Commands (the two low bits select normal, free-running, mode)
 BMP280_READCMD = 0x3F
+BMP280_SLEEPCMD = 0x00
+
+# Standby times between conversions in normal mode (t_sb, seconds)
+BMP280_STANDBY_TIMES = [
+    (0b000, 0.0005),
+    (0b001, 0.0625),
+    (0b010, 0.125),
+    (0b011, 0.25),
+    (0b100, 0.5),
+    (0b101, 1.0),
+    (0b110, 2.0),
+    (0b111, 4.0)
+]
+
+# Oversampling ratio for each osrs_t/osrs_p setting (0 = measurement skipped)
+BMP280_OVERSAMPLING = [0, 1, 2, 4, 8, 16, 16, 16]
+
+# IIR filter coefficient. Off, as recommended by the datasheet for
+# weather monitoring, so each period reports an unfiltered sample.
+BMP280_FILTER_OFF = 0
+
+
+def measurement_time(ctrl_meas):
+    """
+    Returns the maximum time (seconds) of one conversion for a CTRL_MEAS
+    value, per the datasheet:
+    t_measure,max = 1.25 + 2.3 * osrs_t + (2.3 * osrs_p + 0.575) ms
+    """
+    osrs_t = BMP280_OVERSAMPLING[ctrl_meas >> 5]
+    osrs_p = BMP280_OVERSAMPLING[(ctrl_meas >> 2) & 0b111]
+    t_measure_ms = 1.25 + 2.3 * osrs_t
+    if osrs_p:
+        t_measure_ms += 2.3 * osrs_p + 0.575
+    return t_measure_ms / 1000.0
+
+
+def compensate_temperature(adc_T, t1, t1_shl1, t2, t3):
+    """
+    Datasheet 32-bit integer temperature compensation, operating only on
+    locals. Returns degrees celsius and t_fine.
+
+    :param adc_T: raw temperature
+    :param t1: dig_T1, with t1_shl1 = dig_T1 << 1
+    :param t2: dig_T2
+    :param t3: dig_T3
+    """
+    var1 = (((adc_T >> 3) - t1_shl1) * t2) >> 11
+    var2 = (adc_T >> 4) - t1
+    var2 = (((var2 * var2) >> 12) * t3) >> 14
+    t_fine = var1 + var2
+    return ((t_fine * 5 + 128) >> 8) / 100.0, t_fine
+
+
+def compensate_pressure(adc_P, t_fine, p1, p2, p3, p4_shl35, p5, p6,
+                        p7_shl4, p8, p9):
+    """
+    Datasheet 64-bit integer pressure compensation, operating only on
+    locals. Returns Pascals.
+
+    :param adc_P: raw pressure
+    :param t_fine: fine temperature from the same sample
+    :param p1: dig_P1 through dig_P9, with p4_shl35 = dig_P4 << 35 and
+        p7_shl4 = dig_P7 << 4
+    """
+    var1 = t_fine - 128000
+    var2 = var1 * var1 * p6
+    var2 = var2 + ((var1 * p5) << 17)
+    var2 = var2 + p4_shl35
+    var1 = ((var1 * var1 * p3) >> 8) + ((var1 * p2) << 12)
+    var1 = (((1) << 47) + var1) * p1 >> 33
+
+    if var1 == 0:
+        return 0
+
+    # Truncating integer division, matching int64_t division in Bosch's
+    # reference driver, instead of a round trip through a float
+    p = 1048576 - adc_P
+    numerator = ((p << 31) - var2) * 3125
+    p = abs(numerator) // abs(var1)
+    if (numerator < 0) != (var1 < 0):
+        p = -p
+    var1 = (p9 * (p >> 13) * (p >> 13)) >> 25
+    var2 = (p8 * p) >> 19
+
+    p = ((p + var1 + var2) >> 8) + p7_shl4
+    return p / 256.0
 
 
 class InputModule(AbstractInput):
@@ -99,62 +196,110 @@ class InputModule(AbstractInput):
         self.logger = logging.getLogger("mycodo.inputs.bmp280")
 
         if not testing:
-            import Adafruit_GPIO.I2C as I2C
+            from smbus2 import i2c_msg
             self.logger = logging.getLogger(
                 "mycodo.bmp280_{id}".format(id=input_dev.unique_id.split('-')[0]))
 
             self.device_measurements = db_retrieve_table_daemon(
                 DeviceMeasurements).filter(
                     DeviceMeasurements.device_id == input_dev.unique_id)
+            # Settings can only be changed while the input is deactivated,
+            # so the enabled channels are fixed for the life of this object
+            self._en = {channel: bool(self.is_enabled(channel))
+                        for channel in measurements_dict}
 
-            self.i2c_address = int(str(input_dev.i2c_location), 16)
+            self.i2c_address = int(input_dev.i2c_location, 16)
             self.i2c_bus = input_dev.i2c_bus
-            if mode not in [BMP280_ULTRALOWPOWER,
-                            BMP280_STANDARD,
-                            BMP280_HIGHRES,
-                            BMP280_ULTRAHIGHRES]:
+            if mode not in _VALID_MODES:
                 raise ValueError(
                     'Unexpected mode value {0}.  Set mode to one of '
                     'BMP280_ULTRALOWPOWER, BMP280_STANDARD, BMP280_HIGHRES, '
                     'or BMP280_ULTRAHIGHRES'.format(mode))
             self._mode = mode
-            # Create I2C device.
-            i2c = I2C
-            self._device = i2c.get_i2c_device(self.i2c_address,
-                                              busnum=self.i2c_bus)
+            self._ctrl_cmd = BMP280_READCMD | (self._mode << 6)
+            self._i2c_msg = i2c_msg
+            self._bus, self._bus_lock = get_smbus(self.i2c_bus)
             # Load calibration values.
             self._load_calibration()
-            self._tfine = 0
+            self._period = input_dev.period
+            self._configure(self._period)
 
     def get_measurement(self):
         """ Gets the measurement in units by reading the """
-        return_dict = measurements_dict.copy()
-
-        if self.is_enabled(0):
-            return_dict[0]['value'] = self.read_pressure()
+        # Copy each channel's dict so values aren't written to the template
+        return_dict = {channel: dict(measurement)
+                       for channel, measurement in measurements_dict.items()}
+
+        # One conversion provides both values, and pressure compensation
+        # depends on the temperature of the same sample. Values are only
+        # computed when needed, and only stored for enabled channels.
+        adc_P, adc_T = self._read_raw_pt()
+        if adc_P == adc_T == BMP280_RAW_RESET_VALUE:
+            # The sensor was power-cycled (e.g. its supply switched by the
+            # pre-output) and came back in sleep mode without converting.
+            # Reconfiguring waits for the first conversion, so read again.
+            self.logger.debug(
+                'Sensor returned power-on reset values, reconfiguring')
+            self._configure(self._period)
+            adc_P, adc_T = self._read_raw_pt()
+            if adc_P == adc_T == BMP280_RAW_RESET_VALUE:
+                # These decode to plausible values, so don't store them
+                self.logger.error(
+                    "Sensor returned power-on reset values after "
+                    "reconfiguring")
+                return None
+
+        temperature, t_fine = self._compensate_temperature(adc_T)
+
+        if self._en[0] or self._en[2]:
+            pressure = self._compensate_pressure(adc_P, t_fine)
+
+            if self._en[0]:
+                return_dict[0]['value'] = pressure
+
+            if self._en[2]:
+                return_dict[2]['value'] = calculate_altitude(pressure)
+
+        if self._en[1]:
+            return_dict[1]['value'] = temperature
 
-        if self.is_enabled(1):
-            return_dict[1]['value'] = self.read_temperature()
+        return return_dict
 
-        if self.is_enabled(2) and self.is_enabled(0):
-            return_dict[2]['value'] = calculate_altitude(
-                return_dict[0]['value'])
+    def _read(self, register, length):
+        """
+        Reads length bytes starting at register as a single combined
+        write/read transaction, with a repeated start between the two
+        """
+        write = self._i2c_msg.write(self.i2c_address, [register])
+        read = self._i2c_msg.read(self.i2c_address, length)
+        with self._bus_lock:
+            self._bus.i2c_rdwr(write, read)
+        return bytearray(read)
 
-        return return_dict
+    def _write(self, register, value):
+        with self._bus_lock:
+            self._bus.write_byte_data(self.i2c_address, register, value)
 
     def _load_calibration(self):
-        self.cal_REGISTER_DIG_T1 = self._device.readU16LE(BMP280_REGISTER_DIG_T1)  # UINT16
-        self.cal_REGISTER_DIG_T2 = self._device.readS16LE(BMP280_REGISTER_DIG_T2)  # INT16
-        self.cal_REGISTER_DIG_T3 = self._device.readS16LE(BMP280_REGISTER_DIG_T3)  # INT16
-        self.cal_REGISTER_DIG_P1 = self._device.readU16LE(BMP280_REGISTER_DIG_P1)  # UINT16
-        self.cal_REGISTER_DIG_P2 = self._device.readS16LE(BMP280_REGISTER_DIG_P2)  # INT16
-        self.cal_REGISTER_DIG_P3 = self._device.readS16LE(BMP280_REGISTER_DIG_P3)  # INT16
-        self.cal_REGISTER_DIG_P4 = self._device.readS16LE(BMP280_REGISTER_DIG_P4)  # INT16
-        self.cal_REGISTER_DIG_P5 = self._device.readS16LE(BMP280_REGISTER_DIG_P5)  # INT16
-        self.cal_REGISTER_DIG_P6 = self._device.readS16LE(BMP280_REGISTER_DIG_P6)  # INT16
-        self.cal_REGISTER_DIG_P7 = self._device.readS16LE(BMP280_REGISTER_DIG_P7)  # INT16
-        self.cal_REGISTER_DIG_P8 = self._device.readS16LE(BMP280_REGISTER_DIG_P8)  # INT16
-        self.cal_REGISTER_DIG_P9 = self._device.readS16LE(BMP280_REGISTER_DIG_P9)  # INT16
+        # T1..P9 are laid out contiguously from 0x88 to 0x9F, so read the
+        # whole block in a single I2C transaction
+        # T1 and P1 are UINT16, the rest INT16
+        cal = struct.unpack(
+            '<HhhHhhhhhhhh', self._read(BMP280_REGISTER_DIG_T1, 24))
+
+        (self.cal_REGISTER_DIG_T1,
+         self.cal_REGISTER_DIG_T2,
+         self.cal_REGISTER_DIG_T3,
+         self.cal_REGISTER_DIG_P1,
+         self.cal_REGISTER_DIG_P2,
+         self.cal_REGISTER_DIG_P3,
+         self.cal_REGISTER_DIG_P4,
+         self.cal_REGISTER_DIG_P5,
+         self.cal_REGISTER_DIG_P6,
+         self.cal_REGISTER_DIG_P7,
+         self.cal_REGISTER_DIG_P8,
+         self.cal_REGISTER_DIG_P9) = cal
+        self._precompute_calibration()
 
         # self.logger.debug('T1 = {0:6d}'.format(self.cal_REGISTER_DIG_T1))
         # self.logger.debug('T2 = {0:6d}'.format(self.cal_REGISTER_DIG_T2))
@@ -183,88 +328,95 @@ class InputModule(AbstractInput):
         self.cal_REGISTER_DIG_P7 = 15500
         self.cal_REGISTER_DIG_P8 = -14600
         self.cal_REGISTER_DIG_P9 = 6000
-        # reading raw data from registers, and combining into one raw measurement
-
-    def read_raw_temp(self):
-        """Reads the raw (uncompensated) temperature from the sensor."""
-        self._device.write8(
-            BMP280_REGISTER_CONTROL, BMP280_READCMD + (self._mode << 6))
-        if self._mode == BMP280_ULTRALOWPOWER:
-            time.sleep(0.005)
-        elif self._mode == BMP280_HIGHRES:
-            time.sleep(0.014)
-        elif self._mode == BMP280_ULTRAHIGHRES:
-            time.sleep(0.026)
-        else:
-            time.sleep(0.008)
-        msb = self._device.readU8(BMP280_REGISTER_TEMPDATA_MSB)
-        lsb = self._device.readU8(BMP280_REGISTER_TEMPDATA_LSB)
-        xlsb = self._device.readU8(BMP280_REGISTER_TEMPDATA_XLSB)
-        raw = ((msb << 8 | lsb) << 8 | xlsb) >> 4
-        self.logger.debug(
-            'Raw temperature 0x{0:04X} ({1})'.format(raw & 0xFFFF, raw))
-        return raw
-
-    def read_raw_pressure(self):
-        """Reads the raw (uncompensated) pressure level from the sensor."""
-        self._device.write8(BMP280_REGISTER_CONTROL, BMP280_READCMD + (self._mode << 6))
-        if self._mode == BMP280_ULTRALOWPOWER:
-            time.sleep(0.005)
-        elif self._mode == BMP280_HIGHRES:
-            time.sleep(0.014)
-        elif self._mode == BMP280_ULTRAHIGHRES:
-            time.sleep(0.026)
-        else:
-            time.sleep(0.008)
-        msb = self._device.readU8(BMP280_REGISTER_PRESSUREDATA_MSB)
-        lsb = self._device.readU8(BMP280_REGISTER_PRESSUREDATA_LSB)
-        xlsb = self._device.readU8(BMP280_REGISTER_PRESSUREDATA_XLSB)
-        raw = ((msb << 8 | lsb) << 8 | xlsb) >> 4
-        self.logger.debug('Raw pressure 0x{0:04X} ({1})'.format(raw & 0xFFFF, raw))
-        return raw
+        self._precompute_calibration()
 
-    def read_temperature(self):
-        """Gets the compensated temperature in degrees celsius."""
-        adc_T = self.read_raw_temp()
-        TMP_PART1 = (((adc_T >> 3) - (self.cal_REGISTER_DIG_T1 << 1)) * self.cal_REGISTER_DIG_T2) >> 11
-        TMP_PART2 = (((((adc_T >> 4) - self.cal_REGISTER_DIG_T1) * (
-            (adc_T >> 4) - self.cal_REGISTER_DIG_T1)) >> 12) * self.cal_REGISTER_DIG_T3) >> 14
-        TMP_FINE = TMP_PART1 + TMP_PART2
-        self._tfine = TMP_FINE
-        temp = ((TMP_FINE * 5 + 128) >> 8) / 100.0
-        self.logger.debug('Calibrated temperature {0} C'.format(temp))
-        return temp
+    def _precompute_calibration(self):
+        """
+        Cache the calibration terms, including the shifted ones, as tuples in
+        the argument order of compensate_temperature() and
+        compensate_pressure(), so each compensation loads one attribute
+        """
+        self._cal_t = (
+            self.cal_REGISTER_DIG_T1,
+            self.cal_REGISTER_DIG_T1 << 1,
+            self.cal_REGISTER_DIG_T2,
+            self.cal_REGISTER_DIG_T3)
+        self._cal_p = (
+            self.cal_REGISTER_DIG_P1,
+            self.cal_REGISTER_DIG_P2,
+            self.cal_REGISTER_DIG_P3,
+            self.cal_REGISTER_DIG_P4 << 35,
+            self.cal_REGISTER_DIG_P5,
+            self.cal_REGISTER_DIG_P6,
+            self.cal_REGISTER_DIG_P7 << 4,
+            self.cal_REGISTER_DIG_P8,
+            self.cal_REGISTER_DIG_P9)
+
+    def _configure(self, period):
+        """
+        Put the sensor in normal mode, converting continuously with a
+        standby time matched to the measurement period, so samples can be
+        read at any time without triggering and waiting for a conversion.
+        """
+        t_sb = BMP280_STANDBY_TIMES[0][0]
+        for each_t_sb, standby_sec in BMP280_STANDBY_TIMES:
+            if period and standby_sec <= period:
+                t_sb = each_t_sb
 
-    def read_pressure(self):
-        """Gets the compensated pressure in Pascals."""
-        # for pressure calculation we need a temperature, checking if we have one, and reading data if not
-        if self._tfine == 0:
-            self.read_temperature()
+        # The config register is only reliably written in sleep mode
+        self._write(BMP280_REGISTER_CONTROL, BMP280_SLEEPCMD)
+        self._write(
+            BMP280_REGISTER_CONFIG, (t_sb << 5) | (BMP280_FILTER_OFF << 2))
+        self._write(BMP280_REGISTER_CONTROL, self._ctrl_cmd)
 
-        adc_P = self.read_raw_pressure()
-        var1 = self._tfine - 128000
-        var2 = var1 * var1 * self.cal_REGISTER_DIG_P6
-        var2 = var2 + ((var1 * self.cal_REGISTER_DIG_P5) << 17)
-        var2 = var2 + (self.cal_REGISTER_DIG_P4 << 35)
-        var1 = ((var1 * var1 * self.cal_REGISTER_DIG_P3) >> 8) + ((var1 * self.cal_REGISTER_DIG_P2) << 12)
-        var1 = (((1) << 47) + var1) * self.cal_REGISTER_DIG_P1 >> 33
+        # Wait for the first conversion to complete
+        self._wait_for_conversion()
 
-        if var1 == 0:
-            return 0
+    def _wait_for_conversion(self):
+        time.sleep(measurement_time(self._ctrl_cmd))
 
-        p = 1048576 - adc_P
-        p = int((((p << 31) - var2) * 3125) / var1)
-        var1 = (self.cal_REGISTER_DIG_P9 * (p >> 13) * (p >> 13)) >> 25
-        var2 = (self.cal_REGISTER_DIG_P8 * p) >> 19
+    def _read_raw_pt(self):
+        """
+        Reads the raw (uncompensated) pressure and temperature from the
+        sensor. Both come from the latest conversion, read as one 6-byte block.
+        """
+        buf = self._read(BMP280_REGISTER_PRESSUREDATA_MSB, 6)
+        adc_P = int.from_bytes(buf[0:3], 'big') >> 4
+        adc_T = int.from_bytes(buf[3:6], 'big') >> 4
+        # Arguments are only formatted if debug logging is enabled
+        self.logger.debug('Raw pressure 0x%04X (%d)', adc_P & 0xFFFF, adc_P)
+        self.logger.debug('Raw temperature 0x%04X (%d)', adc_T & 0xFFFF, adc_T)
+        return adc_P, adc_T
+
+    def _compensate_temperature(self, adc_T):
+        """
+        Compensates a raw temperature. Returns degrees celsius and the fine
+        temperature (t_fine) needed to compensate pressure from the same sample.
+        """
+        temp, t_fine = compensate_temperature(adc_T, *self._cal_t)
+        self.logger.debug('Calibrated temperature %s C', temp)
+        return temp, t_fine
+
+    def _compensate_pressure(self, adc_P, t_fine):
+        """Compensates a raw pressure, in Pascals."""
+        return compensate_pressure(adc_P, t_fine, *self._cal_p)
 
-        p = ((p + var1 + var2) >> 8) + ((self.cal_REGISTER_DIG_P7) << 4)
-        return p / 256.0
+    def read_temperature(self):
+        """Gets the compensated temperature in degrees celsius."""
+        _, adc_T = self._read_raw_pt()
+        return self._compensate_temperature(adc_T)[0]
+
+    def read_pressure(self):
+        """Gets the compensated pressure in Pascals."""
+        adc_P, adc_T = self._read_raw_pt()
+        _, t_fine = self._compensate_temperature(adc_T)
+        return self._compensate_pressure(adc_P, t_fine)
 
     def read_altitude(self, sealevel_pa=101325.0):
         """Calculates the altitude in meters."""
         pressure = float(self.read_pressure())
-        altitude = 44330.0 * (1.0 - pow(pressure / sealevel_pa, (1.0 / 5.255)))
-        self.logger.debug('Altitude {0} m'.format(altitude))
+        altitude = calculate_altitude(pressure, sealevel_pa)
+        self.logger.debug('Altitude %s m', altitude)
         return altitude
 
     def read_sealevel_pressure(self, altitude_m=0.0):
@@ -274,5 +426,5 @@ class InputModule(AbstractInput):
         """
         pressure = float(self.read_pressure())
         p0 = pressure / pow(1.0 - altitude_m / 44330.0, 5.255)
-        self.logger.debug('Sealevel pressure {0} Pa'.format(p0))
+        self.logger.debug('Sealevel pressure %s Pa', p0)
         return p0
@@ -2,6 +2,8 @@
 import logging
 import time
 
+import os
+
 from mycodo.inputs.base_input import AbstractInput
 
 # Measurements
@@ -49,6 +51,7 @@ class InputModule(AbstractInput):
     def __init__(self, input_dev, testing=False):
         super(InputModule, self).__init__()
         self.logger = logging.getLogger("mycodo.inputs.ds1822")
+        self._w1_fd = None
 
         if not testing:
             from w1thermsensor import W1ThermSensor
@@ -62,29 +65,38 @@ class InputModule(AbstractInput):
             if self.resolution:
                 self.sensor.set_precision(self.resolution)
 
+            # w1thermsensor is only used to locate and configure the sensor.
+            # Readings come straight from its sysfs file, kept open so each
+            # one is a single pread() instead of an open/read/close and parse.
+            self._open_w1_slave()
+
     def get_measurement(self):
         """ Gets the DS1822's temperature in Celsius """
-        return_dict = measurements_dict.copy()
+        # Copy each channel's dict so values aren't written to the template
+        return_dict = {channel: dict(measurement)
+                       for channel, measurement in measurements_dict.items()}
 
         temperature = None
         n = 2
         for i in range(n):
             try:
-                temperature = self.sensor.get_temperature()
+                temperature = self._read_w1_slave()
                 break
             except Exception as e:
-                if i == n:
+                if i == n - 1:
                     self.logger.exception(
                         "{cls} raised an exception when taking a reading: "
                         "{err}".format(cls=type(self).__name__, err=e))
-                time.sleep(1)
+                else:
+                    # A failed read already took up to a full conversion time
+                    time.sleep(0.1)
 
         if temperature == 85:
             self.logger.error(
                 "Measurement returned 85 C, "
                 "indicating an issue communicating with the sensor.")
             return None
-        elif temperature is not None and -55 > temperature > 125:
+        elif temperature is not None and not -55 <= temperature <= 125:
             self.logger.error(
                 "Measurement outside the expected range of -55 C to 125 C: "
                 "{temp} C".format(temp=temperature))
@@ -93,3 +105,42 @@ class InputModule(AbstractInput):
         return_dict[0]['value'] = temperature
 
         return return_dict
+
+    def _read_w1_slave(self):
+        """
+        Reads the temperature, in Celsius, from the w1_slave file, e.g.:
+        72 01 4b 46 7f ff 0e 10 57 : crc=57 YES
+        72 01 4b 46 7f ff 0e 10 57 t=23125
+        """
+        if self._w1_fd is None:
+            self._open_w1_slave()
+        try:
+            data = os.pread(self._w1_fd, 256, 0)
+        except OSError:
+            # The w1 master may have removed and re-added the slave after a
+            # bus glitch, leaving this descriptor dead (ENODEV). Close it so
+            # the retry reopens the new sysfs file.
+            self._close_w1_slave()
+            raise
+        if b'YES' not in data[:data.find(b'\n')]:
+            raise IOError("CRC check failed: {data}".format(data=data))
+        index = data.rfind(b't=')
+        if index == -1:
+            raise IOError("No temperature in reading: {data}".format(data=data))
+        return int(data[index + 2:]) / 1000.0
+
+    def _open_w1_slave(self):
+        self._w1_fd = os.open(str(self.sensor.sensorpath), os.O_RDONLY)
+
+    def _close_w1_slave(self):
+        if self._w1_fd is not None:
+            w1_fd, self._w1_fd = self._w1_fd, None
+            try:
+                os.close(w1_fd)
+            except OSError:
+                pass
+
+    def stop_sensor(self):
+        """ Close the sysfs file when the input is deactivated """
+        self._close_w1_slave()
+        super(InputModule, self).stop_sensor()
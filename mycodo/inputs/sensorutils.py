@@ -5,6 +5,7 @@
 
 import logging
 import math
+import threading
 
 import os
 
@@ -13,6 +14,13 @@ from mycodo.utils.database import db_retrieve_table_daemon
 
 logger = logging.getLogger("mycodo.sensor_utils")
 
+# Exponent of the barometric formula, 1 / 5.255
+_INV_5255 = 1.0 / 5.255
+
+# Shared SMBus objects and their transaction locks, keyed by bus number
+_SMBUS_CACHE = {}
+_SMBUS_CACHE_LOCK = threading.Lock()
+
 
 def calculate_altitude(pressure_pa, sea_level_pa=101325.0):
     """
@@ -21,11 +29,12 @@ def calculate_altitude(pressure_pa, sea_level_pa=101325.0):
     :param sea_level_pa: Pressure (Pa) at sea level
     :return: altitude in meters
     """
-    if pressure_pa < 0:
+    if pressure_pa <= 0:
         logger.error("Erroneous Pressure to calculate altitude: "
                      "{press} Pa".format(press=pressure_pa))
         return None
-    alt_meters = 44330.0 * (1.0 - pow(pressure_pa / sea_level_pa, (1.0 / 5.255)))
+    alt_meters = 44330.0 * (
+        1.0 - math.exp(math.log(pressure_pa / sea_level_pa) * _INV_5255))
     return float("{:.3f}".format(alt_meters))
 
 
@@ -102,3 +111,19 @@ def is_device(path):
     except OSError:
         return None
     return path
+
+
+def get_smbus(bus):
+    """
+    Returns an SMBus object for the I2C bus number, shared by all inputs on
+    that bus, and the lock that must be held for each transaction on it.
+    Input modules are loaded separately per input, so the cache lives here.
+
+    :param bus: I2C bus number
+    :return: tuple of (smbus2.SMBus, threading.Lock)
+    """
+    with _SMBUS_CACHE_LOCK:
+        if bus not in _SMBUS_CACHE:
+            from smbus2 import SMBus
+            _SMBUS_CACHE[bus] = (SMBus(bus), threading.Lock())
+        return _SMBUS_CACHE[bus]
@@ -0,0 +1,67 @@
+# coding=utf-8
+""" Tests for the BMP280 input """
+import mock
+
+from mycodo.inputs.bmp280 import BMP280_REGISTER_CONTROL
+from mycodo.inputs.bmp280 import InputModule as BMP280Sensor
+from mycodo.inputs.bmp280 import compensate_pressure
+from mycodo.inputs.bmp280 import compensate_temperature
+
+# Calibration and raw values from the datasheet compensation example
+DIG_T1, DIG_T2, DIG_T3 = 27504, 26435, -1000
+DIG_P = (36477, -10685, 3024, 2855, 140, -7, 15500, -14600, 6000)
+ADC_T = 519888
+ADC_P = 415148
+
+# Data registers 0xF7-0xFC holding ADC_P and ADC_T, and their reset value
+DATA_EXAMPLE = bytearray([0x65, 0x5A, 0xC0, 0x7E, 0xED, 0x00])
+DATA_RESET = bytearray([0x80, 0x00, 0x00, 0x80, 0x00, 0x00])
+
+
+def bmp280_sensor():
+    """ Return a sensor with the datasheet calibration and all channels enabled """
+    sensor = BMP280Sensor(None, testing=True)
+    sensor._en = {0: True, 1: True, 2: True}
+    sensor._period = 15
+    sensor._ctrl_cmd = 0x7F
+    sensor._load_datasheet_calibration()
+    return sensor
+
+
+def test_compensate_temperature_datasheet_example():
+    """ Verify the datasheet example temperature and t_fine """
+    temperature, t_fine = compensate_temperature(
+        ADC_T, DIG_T1, DIG_T1 << 1, DIG_T2, DIG_T3)
+    assert temperature == 25.08
+    assert t_fine == 128422
+
+
+def test_compensate_pressure_datasheet_example():
+    """ Verify the datasheet example pressure from the 64-bit integer path """
+    p1, p2, p3, p4, p5, p6, p7, p8, p9 = DIG_P
+    pressure = compensate_pressure(
+        ADC_P, 128422, p1, p2, p3, p4 << 35, p5, p6, p7 << 4, p8, p9)
+    assert pressure == 25767233 / 256.0
+
+
+def test_get_measurement_recovers_from_power_cycle():
+    """ Verify reset values cause a reconfiguration and a second read """
+    sensor = bmp280_sensor()
+    with mock.patch.object(sensor, '_read', side_effect=[DATA_RESET, DATA_EXAMPLE]), \
+            mock.patch.object(sensor, '_write') as mock_write, \
+            mock.patch('mycodo.inputs.bmp280.time.sleep'):
+        return_dict = sensor.get_measurement()
+
+    assert mock.call(BMP280_REGISTER_CONTROL, 0x7F) in mock_write.call_args_list
+    assert return_dict[0]['value'] == 25767233 / 256.0
+    assert return_dict[1]['value'] == 25.08
+    assert return_dict[2]['value'] is not None
+
+
+def test_get_measurement_returns_none_if_still_reset():
+    """ Verify reset values after reconfiguring are not stored """
+    sensor = bmp280_sensor()
+    with mock.patch.object(sensor, '_read', side_effect=[DATA_RESET, DATA_RESET]), \
+            mock.patch.object(sensor, '_write'), \
+            mock.patch('mycodo.inputs.bmp280.time.sleep'):
+        assert sensor.get_measurement() is None
@@ -0,0 +1,118 @@
+# coding=utf-8
+""" Tests for the DS1822 input """
+import errno
+
+import mock
+import pytest
+from testfixtures import LogCapture
+
+from mycodo.inputs.ds1822 import InputModule as DS1822Sensor
+
+W1_PATH = '/sys/bus/w1/devices/22-000007d2c0bc/w1_slave'
+W1_FD = 7
+
+
+def w1_data(crc='YES', temperature='t=23125'):
+    """ Return the contents of a w1_slave file """
+    return ('72 01 4b 46 7f ff 0e 10 57 : crc=57 {crc}\n'
+            '72 01 4b 46 7f ff 0e 10 57 {temp}\n'.format(
+                crc=crc, temp=temperature)).encode()
+
+
+def ds1822_sensor():
+    """ Return a sensor whose w1_slave file has not been opened yet """
+    sensor = DS1822Sensor(None, testing=True)
+    sensor.sensor = mock.Mock(sensorpath=W1_PATH)
+    return sensor
+
+
+# ----------------------------
+#   _read_w1_slave()
+# ----------------------------
+def test_read_w1_slave_returns_temperature():
+    """ Verify a valid reading is parsed, opening the file on first use """
+    sensor = ds1822_sensor()
+    with mock.patch('mycodo.inputs.ds1822.os.open', return_value=W1_FD) as mock_open, \
+            mock.patch('mycodo.inputs.ds1822.os.pread', return_value=w1_data()) as mock_pread:
+        assert sensor._read_w1_slave() == 23.125
+    mock_open.assert_called_once_with(W1_PATH, mock.ANY)
+    mock_pread.assert_called_once_with(W1_FD, 256, 0)
+
+
+def test_read_w1_slave_returns_negative_temperature():
+    """ Verify a negative reading is parsed """
+    sensor = ds1822_sensor()
+    with mock.patch('mycodo.inputs.ds1822.os.open', return_value=W1_FD), \
+            mock.patch('mycodo.inputs.ds1822.os.pread', return_value=w1_data(temperature='t=-10062')):
+        assert sensor._read_w1_slave() == -10.062
+
+
+def test_read_w1_slave_raises_on_crc_failure():
+    """ Verify a failed CRC check raises IOError """
+    sensor = ds1822_sensor()
+    with mock.patch('mycodo.inputs.ds1822.os.open', return_value=W1_FD), \
+            mock.patch('mycodo.inputs.ds1822.os.pread', return_value=w1_data(crc='NO')):
+        with pytest.raises(IOError):
+            sensor._read_w1_slave()
+
+
+def test_read_w1_slave_raises_without_temperature():
+    """ Verify a reading without t= raises IOError """
+    sensor = ds1822_sensor()
+    with mock.patch('mycodo.inputs.ds1822.os.open', return_value=W1_FD), \
+            mock.patch('mycodo.inputs.ds1822.os.pread', return_value=w1_data(temperature='')):
+        with pytest.raises(IOError):
+            sensor._read_w1_slave()
+
+
+def test_read_w1_slave_reopens_after_os_error():
+    """ Verify a dead descriptor is closed and reopened on the next read """
+    sensor = ds1822_sensor()
+    with mock.patch('mycodo.inputs.ds1822.os.open', side_effect=[W1_FD, W1_FD + 1]) as mock_open, \
+            mock.patch('mycodo.inputs.ds1822.os.close') as mock_close, \
+            mock.patch('mycodo.inputs.ds1822.os.pread',
+                       side_effect=[OSError(errno.ENODEV, 'No such device'), w1_data()]) as mock_pread:
+        with pytest.raises(OSError):
+            sensor._read_w1_slave()
+        mock_close.assert_called_once_with(W1_FD)
+        assert sensor._w1_fd is None
+
+        assert sensor._read_w1_slave() == 23.125
+    assert mock_open.call_count == 2
+    mock_pread.assert_called_with(W1_FD + 1, 256, 0)
+
+
+# ----------------------------
+#   stop_sensor()
+# ----------------------------
+def test_stop_sensor_without_open_file():
+    """ Verify stop_sensor() works when the w1_slave file was never opened """
+    sensor = DS1822Sensor(None, testing=True)
+    with mock.patch('mycodo.inputs.ds1822.os.close') as mock_close:
+        sensor.stop_sensor()
+    mock_close.assert_not_called()
+    assert not sensor.running
+
+
+# ----------------------------
+#   get_measurement()
+# ----------------------------
+def test_get_measurement_logs_last_failed_attempt():
+    """ Verify only the final failure is logged, after a single short retry delay """
+    sensor = DS1822Sensor(None, testing=True)
+    with LogCapture() as log_cap, \
+            mock.patch.object(sensor, '_read_w1_slave', side_effect=IOError('msg')), \
+            mock.patch('mycodo.inputs.ds1822.time.sleep') as mock_sleep:
+        sensor.get_measurement()
+    mock_sleep.assert_called_once_with(0.1)
+    expected_log = ('mycodo.inputs.ds1822',
+                    'ERROR',
+                    'InputModule raised an exception when taking a reading: msg')
+    assert log_cap.actual().count(expected_log) == 1
+
+
+def test_get_measurement_rejects_out_of_range():
+    """ Verify a reading above 125 C is not stored """
+    sensor = DS1822Sensor(None, testing=True)
+    with mock.patch.object(sensor, '_read_w1_slave', return_value=126.0):
+        assert sensor.get_measurement() is None